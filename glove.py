@@ -1,31 +1,201 @@
+import functools
+import os
 import random
+import sys
 
 import numpy as np
+from scipy.spatial.distance import cdist
 from tqdm import tqdm
 
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
-def load_glove_file(glove_file):
+# Row of the embedding matrix shared by every out-of-vocabulary word
+OOV_ROW = 0
+# Number of lines whose vectors are parsed together by a single np.fromstring call
+PARSE_CHUNK_SIZE = 10000
+
+
+def parse_vectors(vectors, out):
+    """
+    Parse the space separated vector text of several lines straight into rows of the embedding matrix.
+    :param vectors: list of the raw bytes following the word on each line
+    :param out: slice of the embedding matrix with one row per line
+    """
+    out[:] = np.fromstring(b''.join(vectors), dtype=np.float32, sep=' ').reshape(out.shape)
+
+
+def parse_glove_file(glove_file):
     print("Loading Glove Model")
-    f = open(glove_file, 'r', encoding='utf8')
-    model = {}
-    for line in tqdm(f):
-        splitLine = line.split(' ')
-        word = splitLine[0]
-        embedding = np.asarray(splitLine[1:], dtype='float32')
-        model[word] = embedding
-    print("Done.", len(model), " words loaded!")
-    return model
+    with open(glove_file, 'rb') as f:
+        n_words = sum(1 for _ in f)
+        f.seek(0)
+        dim = len(f.readline().split()) - 1
+        f.seek(0)
+        matrix = np.empty((n_words + 1, dim), dtype=np.float32)
+        matrix[OOV_ROW] = random.randint(0, 600)
+        words = []
+        # Reused across chunks so the whole file's text is never held in memory at once
+        vectors = []
+        progress = tqdm(f, total=n_words, mininterval=0.5, miniters=PARSE_CHUNK_SIZE, disable=not sys.stderr.isatty())
+        for line in progress:
+            word, _, vector = line.partition(b' ')
+            words.append(word.decode('utf8'))
+            vectors.append(vector)
+            if len(vectors) == PARSE_CHUNK_SIZE:
+                parse_vectors(vectors, matrix[len(words) - len(vectors) + 1:len(words) + 1])
+                vectors.clear()
+        parse_vectors(vectors, matrix[len(words) - len(vectors) + 1:len(words) + 1])
+    print("Done.", len(words), " words loaded!")
+    return matrix, words
+
+
+def load_glove_file(glove_file):
+    """
+    Load the GloVe embeddings, parsing the text file only once: the parsed matrix and vocabulary are cached
+    next to it (.npy + .vocab.txt) and later runs memory-map the matrix instead of parsing again.
+    :param glove_file: path to the GloVe text file
+    :return: (V + 1, D) float32 matrix whose row OOV_ROW is the out-of-vocabulary vector, word -> row dict
+    """
+    base_path = os.path.splitext(glove_file)[0]
+    matrix_path = base_path + '.npy'
+    vocab_path = base_path + '.vocab.txt'
+    if (os.path.exists(matrix_path) and os.path.exists(vocab_path)
+            and os.path.getmtime(matrix_path) >= os.path.getmtime(glove_file)):
+        print("Loading cached Glove Model")
+        matrix = np.load(matrix_path, mmap_mode='r')
+        with open(vocab_path, 'r', encoding='utf8', newline='') as f:
+            words = f.read().split('\n')
+    else:
+        matrix, words = parse_glove_file(glove_file)
+        # Written to temporary files and moved into place, an interrupted write never leaves a truncated cache
+        vocab_tmp_path = vocab_path + '.tmp'
+        matrix_tmp_path = matrix_path + '.tmp'
+        try:
+            with open(vocab_tmp_path, 'w', encoding='utf8', newline='') as f:
+                f.write('\n'.join(words))
+            with open(matrix_tmp_path, 'wb') as f:
+                np.save(f, matrix)
+            # The matrix goes last, an up to date .npy implies its vocabulary is in place
+            os.replace(vocab_tmp_path, vocab_path)
+            os.replace(matrix_tmp_path, matrix_path)
+        except OSError as e:
+            print(f"Could not cache the Glove Model: {e}")
+        finally:
+            for tmp_path in (vocab_tmp_path, matrix_tmp_path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    # Interned keys are shared with any other interned copy of the word and compare by identity on lookup
+    word_to_idx = {sys.intern(word): idx for idx, word in enumerate(words, start=1)}
+    return matrix, word_to_idx
+
+
+def quantize_embeddings(matrix):
+    """
+    Row-wise symmetric int8 quantization, each row v is stored as round(v / scale) with scale = max(|v|) / 127.
+    :param matrix: (V, D) float32 embedding matrix
+    :return: (V, D) int8 matrix, (V,) float32 scales
+    """
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1
+    quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
 
 
 # Replace 'path/to/glove.txt' with the path to your GloVe file
 glove_path = r'glove.6B.50d.txt'
-glove_embeddings = load_glove_file(glove_path)
-print(f"Loaded {len(glove_embeddings)} word vectors.")
+
+
+@functools.lru_cache(maxsize=1)
+def glove_model():
+    """
+    Load the GloVe embeddings on first use, so importing this module stays cheap.
+    :return: read-only (V + 1, D) float32 matrix, word -> row dict
+    """
+    matrix, word_to_idx = load_glove_file(glove_path)
+    # get_glove_embedding hands out views of the matrix, don't let callers overwrite the shared rows
+    matrix.setflags(write=False)
+    print(f"Loaded {len(word_to_idx)} word vectors.")
+    return matrix, word_to_idx
+
+
+@functools.lru_cache(maxsize=1)
+def quantized_glove_model():
+    return quantize_embeddings(glove_model()[0])
+
+
+@functools.lru_cache(maxsize=1)
+def gpu_glove_model():
+    """
+    Copy of the embedding matrix on the GPU, made once on first use. Requires cupy.
+    """
+    if cp is None:
+        raise ImportError("cupy is required to keep the embeddings on the GPU")
+    return cp.asarray(glove_model()[0])
+
+
+def glove_indices(words):
+    """
+    :param words: sequence of words
+    :return: (len(words),) rows of the words in the embedding matrix, OOV_ROW for out-of-vocabulary words
+    """
+    word_to_idx = glove_model()[1]
+    return np.fromiter((word_to_idx.get(word, OOV_ROW) for word in words), dtype=np.intp, count=len(words))
 
 
 # Load GloVe embeddings
 def get_glove_embedding(word):
-    try:
-        return glove_embeddings[word]
-    except KeyError:
-        return np.array([random.randint(0, 600)] * 50)
\ No newline at end of file
+    matrix, word_to_idx = glove_model()
+    return matrix[word_to_idx.get(word, OOV_ROW)]
+
+
+def get_glove_embeddings(words):
+    """
+    Batched version of get_glove_embedding, gathering the rows of all words in one go.
+    :param words: sequence of words
+    :return: (len(words), D) float32 matrix, out-of-vocabulary words map to the OOV row
+    """
+    return glove_model()[0][glove_indices(words)]
+
+
+def get_glove_embeddings_gpu(words):
+    """
+    Same as get_glove_embeddings, but gathers the rows from the GPU copy of the matrix and returns a cupy array.
+    """
+    return gpu_glove_model()[cp.asarray(glove_indices(words))]
+
+
+def get_glove_embedding_q(word):
+    """
+    Quantized lookup, the embedding is approximately q_row * scale.
+    :return: (D,) int8 row, float32 scale
+    """
+    quantized, scales = quantized_glove_model()
+    idx = glove_model()[1].get(word, OOV_ROW)
+    return quantized[idx], scales[idx]
+
+
+def quantized_dot(words, vector):
+    """
+    Dot product of each word's embedding with a float vector, reading only the int8 rows:
+    the scale is applied once per row after the reduction instead of dequantizing every element.
+    :return: (len(words),) float32 array
+    """
+    quantized, scales = quantized_glove_model()
+    indices = glove_indices(words)
+    vector = np.asarray(vector, dtype=np.float32)
+    return np.einsum('ij,j->i', quantized[indices], vector, dtype=np.float32) * scales[indices]
+
+
+def pairwise_dist(words_a, words_b, metric='euclidean'):
+    """
+    Distances between the embeddings of every pair of words, computed by a single cdist call
+    on the two gathered embedding matrices.
+    :param words_a: sequence of words
+    :param words_b: sequence of words
+    :param metric: any scipy.spatial.distance.cdist metric, e.g. 'euclidean' or 'cosine'
+    :return: (len(words_a), len(words_b)) distance matrix
+    """
+    return cdist(get_glove_embeddings(words_a), get_glove_embeddings(words_b), metric)
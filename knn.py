@@ -0,0 +1,181 @@
+import numpy as np
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# Queries x vectors handled per step of the search, bounds the distance table to 512 x 4096 float64 (16 MB)
+QUERY_BLOCK_SIZE = 512
+VECTOR_BLOCK_SIZE = 4096
+
+
+def normalize_rows(matrix):
+    xp = np if cp is None else cp.get_array_module(matrix)
+    norms = xp.linalg.norm(matrix, axis=1, keepdims=True)
+    # Zero vectors (e.g. the connection between two identical words) stay zero
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class ConnectionIndex:
+    """
+    Exact k nearest neighbours search over a fixed set of vectors, with the same search interface as
+    faiss.IndexFlatL2.
+    All distances of a batch of queries come out of a matrix product: the squared Euclidean distance through the
+    expansion |q - c|^2 = |q|^2 + |c|^2 - 2 q.c, the cosine distance as 1 - q.c over L2 normalized rows.
+    The vectors are stored in a compact dtype and upcast one block at a time, the distances themselves are
+    evaluated in float64. Even then the expansion leaves rounding noise on the small distances between long
+    vectors (e.g. duplicates of a connection involving the out-of-vocabulary embedding come out around 1e-8
+    instead of 0), so the squared Euclidean distances of the k selected neighbours are recomputed directly.
+    With gpu=True the vectors live on the GPU and the searches run there through cupy.
+    """
+
+    def __init__(self, vectors, dtype=np.float32, metric='l2', gpu=False):
+        """
+        :param vectors: (M, D) matrix
+        :param dtype: storage dtype of the vectors, np.float16 halves the storage of the vectors at the cost
+                      of ~3 significant digits per coordinate
+        :param metric: 'l2' for squared Euclidean distances or 'cosine' for cosine distances
+        :param gpu: keep the vectors on the GPU and search there, requires cupy
+        """
+        if metric not in ('l2', 'cosine'):
+            raise ValueError(f"Unknown metric {metric!r}, expected 'l2' or 'cosine'")
+        if gpu and cp is None:
+            raise ImportError("cupy is required to search on the GPU")
+        self._metric = metric
+        self._xp = cp if gpu else np
+        if metric == 'cosine':
+            vectors = normalize_rows(np.asarray(vectors, dtype=np.float64))
+        # Column-major: every block upcast below is then a (D, block) row-major matrix that the GEMM reads as is
+        self._vectors = self._xp.asfortranarray(self._xp.asarray(vectors, dtype=dtype))
+        vectors = self._vectors.astype(np.float64)
+        self._squared_norms = self._xp.einsum('ij,ij->i', vectors, vectors)
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def search(self, queries, k):
+        """
+        :param queries: (Q, D) matrix
+        :param k: number of neighbours to return for each query
+        :return: (Q, k) distances in increasing order (squared Euclidean distances for the 'l2' metric,
+                 1 - cosine similarity for 'cosine'), (Q, k) indices of the corresponding vectors
+        """
+        xp = self._xp
+        queries = np.asarray(queries, dtype=np.float64)
+        if self._metric == 'cosine':
+            queries = normalize_rows(queries)
+        queries = xp.asarray(queries)
+        k = min(k, len(self._vectors))
+        query_squared_norms = xp.einsum('ij,ij->i', queries, queries)[:, None]
+        best_distances = xp.full((len(queries), k), np.inf)
+        best_indices = xp.zeros((len(queries), k), dtype=np.intp)
+        # The vectors are scanned block by block keeping a running top k per query, so the full distance table
+        # never exists. Each block is upcast once and reused by all the query blocks while it is in cache.
+        for start in range(0, len(self._vectors), VECTOR_BLOCK_SIZE):
+            block = self._vectors[start:start + VECTOR_BLOCK_SIZE].astype(np.float64).T
+            for query_start in range(0, len(queries), QUERY_BLOCK_SIZE):
+                rows = slice(query_start, query_start + QUERY_BLOCK_SIZE)
+                distances = self._block_distances(queries[rows], query_squared_norms[rows], block, start)
+                self._merge_top_k(distances, start, best_distances[rows], best_indices[rows])
+        if self._metric == 'l2':
+            # Exact |q - c|^2 of the selected neighbours only, k * D work per query
+            for query_start in range(0, len(queries), QUERY_BLOCK_SIZE):
+                rows = slice(query_start, query_start + QUERY_BLOCK_SIZE)
+                diffs = queries[rows, None, :] - self._vectors[best_indices[rows]].astype(np.float64)
+                best_distances[rows] = xp.einsum('ijk,ijk->ij', diffs, diffs)
+        order = xp.argsort(best_distances, axis=1)
+        return (self._to_numpy(xp.take_along_axis(best_distances, order, axis=1)),
+                self._to_numpy(xp.take_along_axis(best_indices, order, axis=1)))
+
+    def _to_numpy(self, array):
+        return array if self._xp is np else cp.asnumpy(array)
+
+    def _block_distances(self, queries, query_squared_norms, block, start):
+        """
+        Distances of the queries to the (D, block size) upcast block of vectors beginning at start,
+        computed in the buffer of their matrix product.
+        """
+        distances = queries @ block
+        if self._metric == 'cosine':
+            return self._xp.subtract(1, distances, out=distances)
+        distances *= -2
+        distances += query_squared_norms
+        distances += self._squared_norms[start:start + block.shape[1]]
+        # Rounding can make the expansion slightly negative for (near) duplicates
+        return self._xp.maximum(distances, 0, out=distances)
+
+    def _merge_top_k(self, distances, start, best_distances, best_indices):
+        """
+        Merges the distances to the block of vectors beginning at start into the running top k, in place.
+        """
+        xp = self._xp
+        k = best_distances.shape[1]
+        # Reduce the block to its own top k first, only those are merged with the running top k
+        block_k = min(k, distances.shape[1])
+        block_selected = xp.argpartition(distances, block_k - 1, axis=1)[:, :block_k]
+        candidates = xp.concatenate([best_distances, xp.take_along_axis(distances, block_selected, axis=1)], axis=1)
+        candidate_indices = xp.concatenate([best_indices, block_selected + start], axis=1)
+        selected = xp.argpartition(candidates, k - 1, axis=1)[:, :k]
+        best_distances[:] = xp.take_along_axis(candidates, selected, axis=1)
+        best_indices[:] = xp.take_along_axis(candidate_indices, selected, axis=1)
+
+
+class LSHConnectionIndex:
+    """
+    Approximate k nearest neighbours search (squared Euclidean distance), with the same search interface as
+    ConnectionIndex, for when a close enough average distance is all that's needed.
+    Each of the n_tables hash tables buckets the vectors by the signs of their projections on n_bits random
+    hyperplanes. A query is only compared to the vectors sharing one of its buckets, about M / 2^n_bits vectors
+    per table instead of all M, at the cost of sometimes missing a true neighbour.
+    Queries whose buckets hold fewer than k vectors fall back to comparing against all the vectors.
+    The per query Python loop makes it slower than ConnectionIndex at document scale (0.39 s vs 0.11 s for
+    2000 queries over the sample document's 6140 connections), it only pays off on larger sets of vectors
+    (0.23 s vs 0.37 s at M = 20000).
+    """
+
+    def __init__(self, vectors, n_bits=8, n_tables=4, seed=0):
+        self._vectors = np.asarray(vectors, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        self._hyperplanes = rng.standard_normal((n_tables, self._vectors.shape[1], n_bits)).astype(np.float32)
+        self._buckets = []
+        for codes in self._hash(self._vectors):
+            order = np.argsort(codes, kind='stable')
+            bucket_codes, starts = np.unique(codes[order], return_index=True)
+            self._buckets.append(dict(zip(bucket_codes.tolist(), np.split(order, starts[1:]))))
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def _hash(self, vectors):
+        """
+        :return: (n_tables, len(vectors)) bucket of each vector in each table
+        """
+        bits = np.einsum('ij,tjb->tib', vectors, self._hyperplanes) > 0
+        return bits @ (1 << np.arange(bits.shape[2]))
+
+    def search(self, queries, k):
+        """
+        :param queries: (Q, D) matrix
+        :param k: number of neighbours to return for each query
+        :return: (Q, k) squared distances in increasing order, (Q, k) indices of the corresponding vectors
+        """
+        queries = np.asarray(queries, dtype=np.float64)
+        k = min(k, len(self._vectors))
+        distances = np.empty((len(queries), k))
+        indices = np.empty((len(queries), k), dtype=np.intp)
+        no_candidates = np.empty(0, dtype=np.intp)
+        all_candidates = np.arange(len(self._vectors))
+        for i, (query, codes) in enumerate(zip(queries, self._hash(queries.astype(np.float32)).T)):
+            candidates = np.unique(np.concatenate([buckets.get(code, no_candidates)
+                                                   for buckets, code in zip(self._buckets, codes.tolist())]))
+            if len(candidates) < k:
+                # Too few vectors share the query's buckets, the whole set is searched instead
+                candidates = all_candidates
+            diffs = self._vectors[candidates] - query
+            squared_distances = np.einsum('ij,ij->i', diffs, diffs)
+            selected = np.argpartition(squared_distances, k - 1)[:k]
+            selected = selected[np.argsort(squared_distances[selected])]
+            distances[i], indices[i] = squared_distances[selected], candidates[selected]
+        return distances, indices
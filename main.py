@@ -1,23 +1,65 @@
-import heapq
-from typing import Union, Sequence, Tuple, List
+from dataclasses import dataclass
+from typing import Sequence, Tuple, Union
 import math
 import numpy as np
-from nltk.cluster import euclidean_distance
-from scipy.stats import entropy
-from collections import Counter
-from scipy.spatial import distance
-from itertools import combinations
-from scipy.spatial.distance import pdist, squareform
-from tqdm import tqdm
+from scipy.special import entr
 
-from glove import get_glove_embedding
+try:
+    import cupy as cp
+    from cupyx.scipy.special import entr as cupy_entr
+except ImportError:
+    cp = None
+
+from glove import get_glove_embeddings, glove_model
+from knn import ConnectionIndex
 
 
 def euclidean_norm(array):
     return np.linalg.norm(array)
 
 
-def information_of_statement(doc: Sequence[Tuple[str, float]], equal_vocab_probability: float) -> float:
+def get_array_module(array):
+    """
+    :return: cupy for arrays living on the GPU (when cupy is installed), numpy otherwise
+    """
+    return np if cp is None else cp.get_array_module(array)
+
+
+def entropy_in_bits(probabilities):
+    """
+    Base 2 entropy of (possibly unnormalized) probabilities along the last axis,
+    same as scipy.stats.entropy(probabilities, base=2, axis=-1).
+    Uses H = log(s) + sum(-p * log(p)) / s with s = sum(p), so the vector is traversed by a single entr pass
+    instead of materializing the normalized probabilities and their logarithms.
+    Works on cupy arrays as well, in which case everything runs on the GPU.
+    """
+    xp = get_array_module(probabilities)
+    elementwise_entropy = entr if xp is np else cupy_entr
+    total = probabilities.sum(axis=-1)
+    return (xp.log(total) + elementwise_entropy(probabilities).sum(axis=-1) / total) / math.log(2)
+
+
+@dataclass(eq=False)
+class Document:
+    """
+    A document's normalized token probabilities together with their log2, computed once at construction
+    so that a document scored many times does not recompute the logarithms.
+    """
+    probabilities: np.ndarray
+    log2_probabilities: np.ndarray
+
+    @classmethod
+    def from_tokens(cls, doc: Sequence[Tuple[str, float]]) -> "Document":
+        probabilities = np.fromiter((d[1] for d in doc), dtype=np.float64, count=len(doc))
+        probabilities /= probabilities.sum()
+        log2_probabilities = np.log2(probabilities, where=probabilities > 0, out=np.zeros_like(probabilities))
+        return cls(probabilities, log2_probabilities)
+
+    def __len__(self):
+        return len(self.probabilities)
+
+
+def information_of_statement(doc: Union[Document, Sequence[Tuple[str, float]]], equal_vocab_probability: float) -> float:
     """
     Calculates the information of a statement as measured by the
     max_entropy of a statement - the actual entropy of a statement.
@@ -25,18 +67,57 @@ def information_of_statement(doc: Sequence[Tuple[str, float]], equal_vocab_proba
 
     Parameters
     ----------
-    doc : Sequence[Tuple[str, float]]
-      a document represented by a sequence of token, probability pair ("the", 0.89)
+    doc : Union[Document, Sequence[Tuple[str, float]]]
+      a document represented by a sequence of token, probability pair ("the", 0.89),
+      or a Document holding the precomputed probabilities
     equal_vocab_probability : float
       the probability of a token occuring in "thermodynamic equilibrium", equal probabilities
       of each token = 1 / size of vocabulary
 
     """
-    ent = entropy([d[1] for d in doc], base=2)
-    max_ent = entropy([equal_vocab_probability for x in range(len(doc))], base=2)
+    if isinstance(doc, Document):
+        ent = -np.dot(doc.probabilities, doc.log2_probabilities)
+    else:
+        ent = entropy_in_bits(np.fromiter((d[1] for d in doc), dtype=np.float64, count=len(doc)))
+    # The entropy of len(doc) equally likely tokens, once normalized it does not depend on the actual probability
+    max_ent = math.log2(len(doc))
     return max_ent - ent
 
 
+class InformationOfStatement:
+    """
+    information_of_statement for tight loops over many documents: the probability and entropy buffers are
+    allocated once and reused by every call (growing when a longer document comes in).
+    """
+
+    def __init__(self, max_len: int = 1024):
+        self._probabilities = np.empty(max_len)
+        self._entropies = np.empty(max_len)
+
+    def __call__(self, doc: Sequence[Tuple[str, float]], equal_vocab_probability: float) -> float:
+        if len(doc) > len(self._probabilities):
+            self._probabilities = np.empty(len(doc))
+            self._entropies = np.empty(len(doc))
+        probabilities = self._probabilities[:len(doc)]
+        probabilities[:] = [d[1] for d in doc]
+        total = probabilities.sum()
+        ent = (math.log(total) + entr(probabilities, out=self._entropies[:len(doc)]).sum() / total) / math.log(2)
+        return math.log2(len(doc)) - ent
+
+
+def information_of_statements(probabilities, lengths):
+    """
+    Batched information_of_statement for many documents at once.
+    Zero padding does not change the entropy (0 * log(0) = 0), so all documents are handled by whole-matrix operations.
+    :param probabilities: (n_docs, max_len) array, row i holds the lengths[i] token probabilities of document i
+                          followed by zeros
+    :param lengths: (n_docs,) number of tokens of each document
+    :return: (n_docs,) information of each document
+    Both arrays may be cupy arrays, for large batches the computation then stays on the GPU.
+    """
+    return get_array_module(probabilities).log2(lengths) - entropy_in_bits(probabilities)
+
+
 document = """
 The lion (Panthera leo) is a large cat of the genus Panthera, native to Africa and India. It has a muscular, broad-chested body; a short, rounded head; round ears; and a hairy tuft at the end of its tail. It is sexually dimorphic; adult male lions are larger than females and have a prominent mane. It is a social species, forming groups called prides. A lion's pride consists of a few adult males, related females, and cubs. Groups of female lions usually hunt together, preying mostly on large ungulates. The lion is an apex and keystone predator; although some lions scavenge when opportunities occur and have been known to hunt humans, lions typically do not actively seek out and prey on humans.
 
@@ -252,54 +333,69 @@ About 77% of the captive lions registered in the International Species Informati
 """
 
 
-def get_connections(paragraph):
-    connections_ = []
-    for curr_w, next_w in zip(paragraph, paragraph[1:]):
-        connection = get_glove_embedding(curr_w) - get_glove_embedding(next_w)
-        connections_.append(connection)
-    return connections_
-
-
-def process_text(doc):
-    connections_ = []
-    for paragraph in doc.split("\n"):
-        if len(paragraph) < 100:
-            """
-            This is a small paragraph, we can ignore it
-            """
-            continue
-        connections_.extend(get_connections(paragraph))
-    return connections_
-
-
-connections = process_text(document)
-
-
-def find_k_closest_avg(arrays, target, k):
+def get_connections(words, out=None):
     """
-    Find the k closest arrays to the target and return the average of the k closest arrays
-    :param arrays:
-    :param target:
-    :param k:
-    :return:
+    :param words: the words of a paragraph
+    :param out: optional (len(words) - 1, D) array to write the connections into
+    :return: (len(words) - 1, D) matrix of the differences between the embeddings of consecutive words
     """
-    # Calculate the Euclidean distance from the target for each array
-    distances = [np.linalg.norm(arr - target) for arr in arrays]
-
-    # Get the indices of the k smallest distances
-    k_indices = np.argsort(distances)[:k]
-
-    # Return the k closest arrays
-    return np.average([distances[i] for i in k_indices])
+    # One gather of the paragraph's rows, the consecutive pairs are then two views of it
+    embeddings = get_glove_embeddings(words)
+    return np.subtract(embeddings[:-1], embeddings[1:], out=out)
 
 
-def tokenized_probabilities(paragraph, connections):
-    paragraph_connections = get_connections(paragraph)
-    print("connections")
-    return [(d, find_k_closest_avg(connections, d, 3)) for d in paragraph_connections]
+def get_paragraphs(doc):
+    """
+    :return: the paragraphs of the document that are long enough to be scored, by line index
+    """
+    # Small paragraphs, under 100 characters, are ignored, as are single word ones which have no connection to score
+    return {idx: paragraph for idx, paragraph in enumerate(doc.split("\n"))
+            if len(paragraph) >= 100 and len(paragraph.split()) >= 2}
 
 
-for idx, doc in tqdm(enumerate(document.split("\n"))):
-    if len(doc) < 100:
-        continue
-    print(f"doc: {idx} , information: {information_of_statement(tokenized_probabilities(doc, connections), 1 / len(doc))}")
+def process_text(paragraphs):
+    """
+    :param paragraphs: paragraphs by line index
+    :return: (M, D) matrix of all the connections, connections of every paragraph (views into that matrix)
+             by line index
+    """
+    paragraphs_words = {idx: paragraph.split() for idx, paragraph in paragraphs.items()}
+    # Filled in place paragraph by paragraph rather than concatenating a list of per paragraph matrices
+    connections_ = np.empty((sum(max(0, len(words) - 1) for words in paragraphs_words.values()),
+                             glove_model()[0].shape[1]), dtype=np.float32)
+    paragraphs_connections_ = {}
+    offset = 0
+    for idx, words in paragraphs_words.items():
+        paragraph_connections = connections_[offset:offset + max(0, len(words) - 1)]
+        paragraphs_connections_[idx] = get_connections(words, out=paragraph_connections)
+        offset += len(paragraph_connections)
+    return connections_, paragraphs_connections_
+
+
+def tokenized_probabilities(queries, index):
+    """
+    :param queries: (Q, D) connections to score
+    :return: (Q,) probability of each connection, its average Euclidean distance to its 3 closest connections
+             in the document
+    """
+    # Recurring word pairs ("of the", "in the") give identical connections, search each distinct one only once
+    unique_queries, inverse = np.unique(queries, axis=0, return_inverse=True)
+    squared_distances, _ = index.search(unique_queries, 3)
+    return np.sqrt(squared_distances).mean(axis=1)[inverse.reshape(-1)]
+
+
+# Computed once, the same connections are both indexed and scored
+paragraphs = get_paragraphs(document)
+connections, paragraphs_connections = process_text(paragraphs)
+# A document without any paragraph long enough has nothing to index or score
+if paragraphs:
+    connections_index = ConnectionIndex(connections)
+    # All the connections are scored by one search and all the paragraphs by one information_of_statements call
+    probabilities = tokenized_probabilities(connections, connections_index)
+    lengths = np.array([len(paragraph_connections) for paragraph_connections in paragraphs_connections.values()])
+    # One zero padded row per paragraph, the connections matrix holds the paragraphs one after the other
+    padded_probabilities = np.zeros((len(lengths), lengths.max()))
+    padded_probabilities[np.arange(lengths.max()) < lengths[:, None]] = probabilities
+    information = information_of_statements(padded_probabilities, lengths)
+    print("\n".join(f"doc: {idx} , information: {paragraph_information}"
+                    for idx, paragraph_information in zip(paragraphs, information)))